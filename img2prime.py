@@ -1,40 +1,264 @@
 from PIL import Image
 import argparse
+import atexit
+import concurrent.futures
+import math
+import multiprocessing
+import numpy as np
 import random
+import sys
 import textwrap
 
+if hasattr(sys, 'set_int_max_str_digits'):
+    "we deliberately convert very large numbers to and from strings"
+    sys.set_int_max_str_digits(0)
+
+try:
+    from gmpy2 import mpz, powmod, next_prime
+except ImportError:
+    "gmpy2 is optional; CPython's own bignums work, just slower"
+    mpz = int
+    powmod = pow
+    next_prime = None
+
+try:
+    import numba
+except ImportError:
+    "numba is optional too; without it small numbers take the same"
+    "path as the big ones"
+    numba = None
+
 
 def to_ascii_art(image, mapping):
     """Convert each pixel in an image to a character."""
-    ascii_art = ''
-    for y in range(image.height):
-        for x in range(image.width):
-            "assuming a greyscale image, so we'll only use the first channel"
-            value = image.getpixel((x, y))[0]
-            ascii_art += mapping[value]
-        ascii_art += '\n'
-    return ascii_art
+    "convert to greyscale so every pixel is a single byte"
+    greyscale = image.convert('L')
+    "translate is a single C pass through the 256-byte lookup table"
+    raw = greyscale.tobytes().translate(mapping)
+    width = greyscale.width
+    rows = [raw[start:start + width] for start in range(0, len(raw), width)]
+    return b'\n'.join(rows).decode() + '\n'
 
 
 def linear_map(inputs, outputs):
     ratio = len(outputs)/len(inputs)
-    mapping = {}
-    for index, value in enumerate(inputs):
-        mapping[value] = outputs[int(index*ratio)]
-    return mapping
+    chars = ''.join(outputs[int(index*ratio)] for index in range(len(inputs)))
+    return chars.encode()
 
 
-def probably_prime(
-    number,
-    primes=[
-        int(p) for p in open('primes.txt').read().split()
-    ]
-):
+"these seven bases prove primality for every number below 2**64,"
+"see https://miller-rabin.appspot.com/"
+DETERMINISTIC_BASES = (2, 325, 9375, 28178, 450775, 9780504, 1795265022)
+DETERMINISTIC_LIMIT = 1 << 64
+
+WORKER_POOL = None
+
+
+def worker_pool():
+    """Lazily create the shared worker pool.
+
+       Worker processes must not start nested pools of their own, so
+       callers already inside a worker get None instead.
+    """
+    global WORKER_POOL
+    if multiprocessing.parent_process() is not None:
+        return None
+    if WORKER_POOL is None:
+        WORKER_POOL = multiprocessing.Pool(multiprocessing.cpu_count())
+        "tear the pool down explicitly at exit; leaving it to __del__"
+        "during interpreter shutdown races the pickler and spews"
+        "AttributeError noise on stderr"
+        atexit.register(shutdown_worker_pool)
+    return WORKER_POOL
+
+
+def shutdown_worker_pool():
+    global WORKER_POOL
+    if WORKER_POOL is not None:
+        WORKER_POOL.terminate()
+        WORKER_POOL.join()
+        WORKER_POOL = None
+
+
+def miller_rabin_witness(witness):
+    """Test a single Miller-Rabin witness, at top level so a Pool can run it.
+
+       One exponentiation brings us to a**d; the rest of the ladder up
+       to a**(n-1) is just repeated squaring, checked as it happens.
+    """
+    n, d, r, a = witness
+    minus_one = n - 1
+    x = powmod(a, d, n)
+    if x == 1 or x == minus_one:
+        return True
+    for j in range(r-1):
+        "a bare square-and-reduce; no point re-entering powmod just to"
+        "raise to the power of two"
+        x = x * x % n
+        if x == minus_one:
+            "n passes this witness; any further squaring is wasted work"
+            return True
+        if x == 1:
+            return False
+    return False
+
+
+"below 2**31 the bases (2, 7, 61) are a deterministic witness set and"
+"every intermediate product fits comfortably in an int64, which is as"
+"far as numba's machine integers reach"
+JIT_LIMIT = 1 << 31
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def miller_rabin_small(n):
+        """Deterministic Miller-Rabin for n below JIT_LIMIT, compiled
+           to a tight machine-integer loop.
+        """
+        if n < 2:
+            return False
+        for a in (2, 7, 61):
+            if n % a == 0:
+                return n == a
+        d = n - 1
+        r = 0
+        while d % 2 == 0:
+            d //= 2
+            r += 1
+        for a in (2, 7, 61):
+            x = 1
+            base = a
+            e = d
+            while e:
+                if e & 1:
+                    x = x * base % n
+                base = base * base % n
+                e >>= 1
+            if x == 1 or x == n - 1:
+                continue
+            passed = False
+            for j in range(r - 1):
+                x = x * x % n
+                if x == n - 1:
+                    passed = True
+                    break
+            if not passed:
+                return False
+        return True
+else:
+    miller_rabin_small = None
+
+
+def miller_rabin(n, k=10):
+    """Check if a number n is probaby prime.
+
+       See https://en.wikipedia.org/wiki/Miller%E2%80%93Rabin_primality_test
+
+       The k witnesses are independent, so they are spread over the
+       worker pool and we bail on the first one to report composite.
+    """
+    if miller_rabin_small is not None and n < JIT_LIMIT:
+        return bool(miller_rabin_small(n))
+    "convert to mpz once here so every witness reuses the same bignum"
+    "operands instead of re-converting per powmod call"
+    n = mpz(n)
+    "factor n-1 as d * 2**r with d odd"
+    r = 0
+    d = n - 1
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    if n < DETERMINISTIC_LIMIT:
+        "below the limit the fixed bases give a proof, not a probability,"
+        "and such small numbers aren't worth shipping to the pool"
+        witnesses = []
+        for base in DETERMINISTIC_BASES:
+            "the verified result only holds for the bases exactly as"
+            "listed; a base at or above n is reduced mod n, and skipped"
+            "when that degenerates into a triviality"
+            a = base % n
+            if a == 0 or a == 1 or a == n - 1:
+                continue
+            witnesses.append((n, d, r, mpz(a)))
+        return all(map(miller_rabin_witness, witnesses))
+    "randint's rejection sampling bookkeeping is pure Python and adds up"
+    "at k draws per candidate; getrandbits with one range check is enough"
+    bits = n.bit_length()
+    limit = n - 2
+    witnesses = []
+    while len(witnesses) < k:
+        a = random.getrandbits(bits)
+        if 2 <= a <= limit:
+            witnesses.append((n, d, r, mpz(a)))
+    pool = worker_pool()
+    if pool is None:
+        return all(map(miller_rabin_witness, witnesses))
+    for passed in pool.imap_unordered(miller_rabin_witness, witnesses):
+        if not passed:
+            return False
+    return True
+
+
+def sieve_primes(count):
+    """Find the first count primes with a sieve of Eratosthenes."""
+    limit = 30
+    while True:
+        composite = bytearray(limit + 1)
+        primes = []
+        for n in range(2, limit + 1):
+            if composite[n]:
+                continue
+            primes.append(n)
+            if len(primes) == count:
+                return primes
+            for multiple in range(n*n, limit + 1, n):
+                composite[multiple] = 1
+        limit *= 2
+
+
+"2 is left out since every candidate we test is odd"
+SMALL_PRIMES = sieve_primes(2000)[1:]
+SMALL_PRIMES_SET = frozenset(SMALL_PRIMES)
+"products of 64 sieved primes each: one gcd against a chunk tells us"
+"whether any of its 64 primes divides the candidate"
+PRIME_CHUNKS = [
+    math.prod(SMALL_PRIMES[i:i + 64])
+    for i in range(0, len(SMALL_PRIMES), 64)
+]
+
+
+def fast_is_prime(number):
+    """Check if a number is probably prime.
+
+       Same idea as probably_prime, but gated on a larger sieved prime
+       list so fewer candidates reach the costly Miller-Rabin test.
+    """
+    if number <= SMALL_PRIMES[-1]:
+        "numbers inside the sieve's range are answered by it directly"
+        return number == 2 or number in SMALL_PRIMES_SET
+    if number % 2 == 0:
+        return False
+    for chunk in PRIME_CHUNKS:
+        if math.gcd(number, chunk) != 1:
+            return False
+    return miller_rabin(number)
+
+
+def load_primes(path='primes.txt'):
+    """Read the shipped small-prime list, once, at import time."""
+    with open(path) as f:
+        return tuple(int(p) for p in f.read().split())
+
+
+PRIMES = load_primes()
+
+
+def probably_prime(number, primes=PRIMES):
     """Check if a number is probably prime."""
     for prime in primes:
-        "Rule out candidates with small prime factors first"
+        "Rule out candidates with small prime factors first,"
+        "taking care not to reject the small primes themselves"
         if number % prime == 0:
-            return False
+            return number == prime
     "If the candidate might still be prime, use the more costly Miller-Rabin"
     return miller_rabin(number)
 
@@ -63,13 +287,51 @@ def skipahead(test_function, args):
     return f
 
 
-def find_next_prime(number, args, test_function=probably_prime):
+"the residues mod 30 that are coprime to 2, 3 and 5, and the gaps"
+"between consecutive ones"
+WHEEL = (1, 7, 11, 13, 17, 19, 23, 29)
+WHEEL_STEPS = (6, 4, 2, 4, 2, 4, 6, 2)
+
+
+def find_next_prime(number, args, test_function=miller_rabin):
+    if (next_prime is not None and test_function is miller_rabin
+            and args.quiet):
+        "GMP runs the whole sieve-and-test loop in C; only usable when"
+        "nobody asked for per-candidate progress or a custom test"
+        return int(next_prime(number - 1))
+    if number <= SMALL_PRIMES[-1]:
+        "the residue sieve can never pass its own primes (p % p == 0),"
+        "so starts inside its range are answered from the sieve directly"
+        if number <= 2:
+            return 2
+        for prime in SMALL_PRIMES:
+            if prime >= number:
+                return prime
+    "align the start on the 2/3/5 wheel; any number at another residue"
+    "mod 30 is divisible by 2, 3 or 5 and needn't be looked at"
+    start = number % 30
+    for wheel_index, residue in enumerate(WHEEL):
+        if residue >= start:
+            number += residue - start
+            break
+    else:
+        wheel_index = 0
+        number += 31 - start
     i = 1
-    while not test_function(number):
+    "Track number % p for each small prime instead of redoing the"
+    "expensive bignum modulos; each wheel step is then a cheap vector"
+    "update."
+    primes = np.array(SMALL_PRIMES, dtype=np.int32)
+    residues = np.array([number % p for p in SMALL_PRIMES], dtype=np.int32)
+    while not (residues.all() and test_function(number)):
         if not args.quiet:
             print("checked {} candidates".format(i))
         i += 1
-        number += 2
+        step = WHEEL_STEPS[wheel_index]
+        wheel_index = (wheel_index + 1) % len(WHEEL_STEPS)
+        number += step
+        residues += step
+        residues %= primes
     return number
 
 
@@ -77,67 +339,101 @@ def find_prime_by_morphing(
         number,
         args,
         printer=print,
-        test_function=probably_prime
+        test_function=fast_is_prime
 ):
     trials = 0
     morphs = {morph[0]: morph[1:] for morph in args.morph}
+    batch_size = 2 * multiprocessing.cpu_count()
+    "closures don't pickle, so only module-level test functions can be"
+    "shipped to the worker processes; anything else runs in-process"
+    parallel = test_function in (fast_is_prime, probably_prime, miller_rabin)
+    executor = None
+    if parallel and multiprocessing.parent_process() is None:
+        executor = concurrent.futures.ProcessPoolExecutor()
 
-    def find_prime_by_morphing_recursive(number, recursion_depth):
-        nonlocal trials
-        digits = list(str(number))
+    "different edit orders can reach the same number; remember every"
+    "candidate ever generated so each one is tested and expanded once"
+    seen = set()
+    "place values, precomputed so a single-digit edit updates the"
+    "integer with one bignum add instead of an O(d^2) str->int parse"
+    pow10 = [10**i for i in range(len(str(number)))]
+
+    def candidates(digits, value, recursion_depth):
+        "Yield the sibling morphs of digits, one edit away each."
         for index in range(len(digits)):
             digit = digits[-index]
             if index >= recursion_depth:
                 break
-            try:
-                for morph in morphs[digit]:
-                    morphed = list(digits)
-                    morphed[-index] = morph
-                    morphed = ''.join(morphed)
-                    if not args.quiet:
-                        printer('Tested {} numbers so far.'.format(trials))
-                        printer(morphed)
-                    if test_function(int(morphed)):
-                        return int(morphed)
-                    trials += 1
-                    prime = find_prime_by_morphing_recursive(
-                        morphed,
-                        recursion_depth=index,
-                    )
-                    if prime:
-                        return prime
-            except KeyError:
-                continue
-
-    return find_prime_by_morphing_recursive(
-        number,
-        recursion_depth=len(str(number)),
-    )
+            place = index - 1 if index else len(digits) - 1
+            for morph in morphs.get(digit, ''):
+                morphed = list(digits)
+                morphed[-index] = morph
+                morphed = ''.join(morphed)
+                if morphed in seen:
+                    continue
+                seen.add(morphed)
+                delta = (int(morph) - int(digit)) * pow10[place]
+                yield morphed, value + delta, index
 
+    def test_batch(batch):
+        nonlocal trials
+        for morphed, value, index in batch:
+            if not args.quiet:
+                printer('Tested {} numbers so far.'.format(trials))
+                printer(morphed)
+        if executor is None:
+            for morphed, value, index in batch:
+                trials += 1
+                "parity is free to check now; even numbers can't be prime"
+                if value % 2 == 0:
+                    continue
+                if test_function(value):
+                    return value
+            return None
+        futures = {
+            executor.submit(test_function, value): value
+            for morphed, value, index in batch
+            if value % 2
+        }
+        trials += len(batch)
+        prime = None
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                prime = futures[future]
+                break
+        "the first prime wins; anything still queued is wasted work"
+        for future in futures:
+            future.cancel()
+        return prime
 
-def miller_rabin(n, k=10):
-    """Check if a number n is probaby prime.
+    def find_prime_by_morphing_recursive(digits, value, recursion_depth):
+        siblings = list(candidates(digits, value, recursion_depth))
+        "test whole batches of siblings before descending into any subtree"
+        for start in range(0, len(siblings), batch_size):
+            prime = test_batch(siblings[start:start + batch_size])
+            if prime:
+                return prime
+        for morphed, morphed_value, index in siblings:
+            prime = find_prime_by_morphing_recursive(
+                list(morphed),
+                morphed_value,
+                recursion_depth=index,
+            )
+            if prime:
+                return prime
 
-       See https://en.wikipedia.org/wiki/Miller%E2%80%93Rabin_primality_test
-    """
-    r = 1
-    d = (n-1) // 2
-    while d % 2 == 0:
-        d //= 2
-        r *= 2
-    for i in range(k):
-        a = random.randint(2, n - 2)
-        x = pow(a, d, n)
-        if x == 1 or x == n - 1:
-            continue
-        for j in range(r-1):
-            x = pow(x, 2, n)
-            if x == 1:
-                return False
-            if x == n - 1:
-                continue
-        return False
-    return True
+    try:
+        "str(number) costs O(digits^2); do it once and pass the digit"
+        "list down the recursion instead of an integer"
+        digits = list(str(number))
+        return find_prime_by_morphing_recursive(
+            digits,
+            number,
+            recursion_depth=len(digits),
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
 
 def prettyprinter(width):
@@ -182,9 +478,13 @@ if __name__ == '__main__':
     if not args.quiet:
         print("Base ascii art: \n\n{}".format(ascii))
 
-    number = int(ascii.replace('\n', ''))
+    "GMP parses huge digit strings in subquadratic time, where int()"
+    "costs O(digits^2); without gmpy2 mpz is just int anyway"
+    number = int(mpz(ascii.replace('\n', ''), 10))
 
-    test_function = probably_prime
+    "the ascending search sieves its candidates itself, so it only needs"
+    "the Miller-Rabin half of the test"
+    test_function = fast_is_prime if args.morph else miller_rabin
     if args.skip:
         test_function = skipahead(test_function, args=args)
 